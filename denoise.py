@@ -0,0 +1,311 @@
+"""
+Variance-guided edge-aware (a-trous wavelet) denoising of Monte Carlo
+accumulation buffers, on the GPU or on the CPU with numpy.
+
+Per-pixel variance is estimated by accumulating the second moment of the
+samples. The samples are reconstructed from two consecutive means, which
+assumes the shader accumulates like the examples do:
+
+    (base_color * frame_number + sample) / (frame_number + 1.0)
+"""
+
+import numpy
+
+from gl_objects import Shader
+from output_shader import formatResolution
+
+LUMINANCE = numpy.array([0.2126, 0.7152, 0.0722])
+
+# B3 spline, the 1D a-trous kernel
+KERNEL = [1/16.0, 1/4.0, 3/8.0, 1/4.0, 1/16.0]
+
+AUX_OUTPUTS = ('albedo', 'normal')
+
+def buildMomentFragmentShader(resolution):
+    return """
+    uniform sampler2D mean;
+    uniform sampler2D previous_mean;
+    uniform sampler2D previous_moment;
+    uniform float frame_number;
+    void main() {
+        %s;
+        vec2 uv = gl_FragCoord.xy / resolution.xy;
+        vec3 x = (frame_number + 1.0) * texture2D(mean, uv).xyz
+            - frame_number * texture2D(previous_mean, uv).xyz;
+        vec3 m2 = texture2D(previous_moment, uv).xyz;
+        gl_FragColor = vec4((m2 * frame_number + x*x) / (frame_number + 1.0), 1.0);
+    }""" % formatResolution(resolution)
+
+def buildVarianceFragmentShader(resolution):
+    return """
+    uniform sampler2D mean;
+    uniform sampler2D moment;
+    uniform float frame_number;
+    const vec3 LUMINANCE = vec3(0.2126, 0.7152, 0.0722);
+    void main() {
+        %s;
+        // luminance variance of the accumulated mean
+        vec2 uv = gl_FragCoord.xy / resolution.xy;
+        vec3 m = texture2D(mean, uv).xyz;
+        vec3 v = max(texture2D(moment, uv).xyz - m*m, vec3(0.0));
+        gl_FragColor = vec4(dot(v, LUMINANCE) / (frame_number + 1.0), 0.0, 0.0, 1.0);
+    }""" % formatResolution(resolution)
+
+def buildATrousFragmentShader(resolution, aux=()):
+    # writes the filtered color to gl_FragData[0] and its variance,
+    # for the next iteration, to gl_FragData[1]
+    defines = ''.join('#define USE_%s\n' % name.upper() for name in aux)
+    return defines + """
+    uniform sampler2D color;
+    uniform sampler2D variance;
+    uniform float step_size;
+    uniform float sigma_color;
+    #ifdef USE_ALBEDO
+    uniform sampler2D albedo;
+    uniform float sigma_albedo;
+    #endif
+    #ifdef USE_NORMAL
+    uniform sampler2D normal;
+    uniform float sigma_normal;
+    #endif
+
+    const vec3 LUMINANCE = vec3(0.2126, 0.7152, 0.0722);
+
+    float kernel_weight(float d) {
+        d = abs(d);
+        if (d < 0.5) return 0.375;
+        if (d < 1.5) return 0.25;
+        return 0.0625;
+    }
+
+    void main() {
+        %s;
+        vec2 p = gl_FragCoord.xy;
+        vec2 uv_p = p / resolution;
+        vec3 c_p = texture2D(color, uv_p).xyz;
+        float l_p = dot(c_p, LUMINANCE);
+        float var_p = texture2D(variance, uv_p).x;
+        #ifdef USE_ALBEDO
+        vec3 a_p = texture2D(albedo, uv_p).xyz;
+        #endif
+        #ifdef USE_NORMAL
+        vec3 n_p = texture2D(normal, uv_p).xyz;
+        #endif
+
+        vec3 sum = vec3(0.0);
+        float var_sum = 0.0;
+        float weight_sum = 0.0;
+        for (float dy = -2.0; dy <= 2.0; dy += 1.0) {
+            for (float dx = -2.0; dx <= 2.0; dx += 1.0) {
+                vec2 q = clamp(p + vec2(dx, dy)*step_size, vec2(0.5), resolution - vec2(0.5));
+                vec2 uv_q = q / resolution;
+                vec3 c_q = texture2D(color, uv_q).xyz;
+                float var_q = texture2D(variance, uv_q).x;
+
+                float w = kernel_weight(dx) * kernel_weight(dy);
+                float sigma = sigma_color * sqrt(var_p + var_q) + 1e-6;
+                w *= exp(-abs(l_p - dot(c_q, LUMINANCE)) / sigma);
+                #ifdef USE_ALBEDO
+                vec3 da = a_p - texture2D(albedo, uv_q).xyz;
+                w *= exp(-dot(da, da) / (sigma_albedo*sigma_albedo + 1e-6));
+                #endif
+                #ifdef USE_NORMAL
+                w *= pow(max(dot(n_p, texture2D(normal, uv_q).xyz), 0.0), sigma_normal);
+                #endif
+
+                sum += w * c_q;
+                var_sum += w * w * var_q;
+                weight_sum += w;
+            }
+        }
+
+        if (weight_sum > 0.0) {
+            gl_FragData[0] = vec4(sum / weight_sum, 1.0);
+            gl_FragData[1] = vec4(var_sum / (weight_sum * weight_sum), 0.0, 0.0, 1.0);
+        } else {
+            gl_FragData[0] = vec4(c_p, 1.0);
+            gl_FragData[1] = vec4(var_p, 0.0, 0.0, 1.0);
+        }
+    }""" % formatResolution(resolution)
+
+def atrous_denoise(color, mean, moment, n_samples, albedo=None, normal=None,
+        iterations=4, sigma_color=4.0, sigma_albedo=0.1, sigma_normal=128.0):
+    """
+    CPU version of the a-trous filter. All images are float arrays of
+    shape (h, w, 3) and n_samples is the last frame_number. Like on the
+    GPU, the variance is filtered along with the color (with squared
+    weights) so that the edge-stopping function tightens on each iteration
+    """
+    h, w = color.shape[:2]
+
+    variance = numpy.maximum(moment - mean**2, 0.0)
+    variance = numpy.dot(variance, LUMINANCE) / (n_samples + 1.0)
+
+    def shifted(image, dy, dx):
+        ys = numpy.clip(numpy.arange(h) + dy, 0, h - 1)
+        xs = numpy.clip(numpy.arange(w) + dx, 0, w - 1)
+        return image[ys][:, xs]
+
+    result = numpy.asarray(color, dtype=numpy.float64)
+    for i in range(iterations):
+        step = 2**i
+        lum = numpy.dot(result, LUMINANCE)
+        total = numpy.zeros_like(result)
+        var_total = numpy.zeros((h, w))
+        weight_sum = numpy.zeros((h, w))
+
+        for ky, kdy in enumerate(KERNEL):
+            for kx, kdx in enumerate(KERNEL):
+                dy, dx = (ky - 2)*step, (kx - 2)*step
+                c_q = shifted(result, dy, dx)
+                var_q = shifted(variance, dy, dx)
+
+                sigma = sigma_color * numpy.sqrt(variance + var_q) + 1e-6
+                weight = kdy * kdx * numpy.exp(-numpy.abs(lum - shifted(lum, dy, dx)) / sigma)
+                if albedo is not None:
+                    da = albedo - shifted(albedo, dy, dx)
+                    weight *= numpy.exp(-numpy.sum(da**2, axis=2) / (sigma_albedo**2 + 1e-6))
+                if normal is not None:
+                    dot = numpy.sum(normal * shifted(normal, dy, dx), axis=2)
+                    weight *= numpy.maximum(dot, 0.0) ** sigma_normal
+
+                total += weight[..., numpy.newaxis] * c_q
+                var_total += weight**2 * var_q
+                weight_sum += weight
+
+        valid = weight_sum > 0
+        total[valid] /= weight_sum[valid][:, numpy.newaxis]
+        total[~valid] = result[~valid]
+        var_total[valid] /= weight_sum[valid]**2
+        var_total[~valid] = variance[~valid]
+        result = total
+        variance = var_total
+
+    return result.astype(numpy.float32)
+
+def parse_denoise_params(spec_value, mode=None):
+    """
+    Denoiser keyword arguments from the "denoise" field of a spec
+    (true, "gpu", "cpu" or a dict) and the command line override
+    ("off", "gpu" or "cpu"). None if denoising is disabled
+    """
+    if mode == 'off' or (mode is None and not spec_value):
+        return None
+
+    if isinstance(spec_value, dict):
+        params = dict(spec_value)
+    elif isinstance(spec_value, str):
+        params = { 'mode': spec_value }
+    else:
+        params = {}
+
+    if mode is not None:
+        params['mode'] = mode
+    return params
+
+class Denoiser:
+    def __init__(self, renderer, mode='gpu', iterations=4, aux=(),
+            sigma_color=4.0, sigma_albedo=0.1, sigma_normal=128.0):
+        """
+        Denoise the output of a Monte Carlo Renderer. The names in aux
+        must be among the aux_outputs of the renderer
+        """
+        if not renderer.monte_carlo:
+            raise RuntimeError('denoising requires a monte_carlo spec')
+        if mode not in ('gpu', 'cpu'):
+            raise RuntimeError('invalid denoise mode %s' % mode)
+        for name in aux:
+            if name not in AUX_OUTPUTS or name not in renderer.aux:
+                raise RuntimeError('invalid denoise aux output %s' % name)
+
+        self.renderer = renderer
+        self.mode = mode
+        self.iterations = iterations
+        self.aux = list(aux)
+        self.sigmas = {
+            'sigma_color': float(sigma_color),
+            'sigma_albedo': float(sigma_albedo),
+            'sigma_normal': float(sigma_normal)
+        }
+
+        resolution = renderer.shader.resolution
+        self.moments = [renderer.new_float_texture() for _ in range(2)]
+        self.moment_shader = self._build_shader(buildMomentFragmentShader(resolution),
+            ['mean', 'previous_mean', 'previous_moment', 'frame_number'])
+
+        if mode == 'gpu':
+            self.filtered = [renderer.new_float_texture() for _ in range(2)]
+            self.variances = [renderer.new_float_texture() for _ in range(2)]
+            self.variance_shader = self._build_shader(buildVarianceFragmentShader(resolution),
+                ['mean', 'moment', 'frame_number'])
+            uniforms = ['color', 'variance', 'step_size', 'sigma_color']
+            uniforms += self.aux + ['sigma_' + name for name in self.aux]
+            self.filter_shader = self._build_shader(
+                buildATrousFragmentShader(resolution, self.aux), uniforms)
+        else:
+            self.cpu_output = renderer.new_float_texture()
+
+    def _build_shader(self, source, uniform_names):
+        shader = Shader(self.renderer.shader.resolution, source,
+            uniforms = { name: None for name in uniform_names })
+        shader.build()
+        return shader
+
+    def _render_pass(self, shader, targets, **uniforms):
+        from gl_boilerplate import texture_rect
+        with shader.use_program():
+            with self.renderer.framebuffer.render_to_texture(*targets):
+                shader.set_uniforms(**uniforms)
+                texture_rect(shader.aspect_ratio)
+
+    def accumulate(self):
+        "Update the second moment, call after each Renderer.render"
+        r = self.renderer
+        self._render_pass(self.moment_shader, [self.moments[1]],
+            mean = r.latest,
+            previous_mean = r.textures[1],
+            previous_moment = self.moments[0],
+            frame_number = float(r.n_samples))
+        self.moments = self.moments[::-1]
+
+    def denoise(self):
+        "Denoise the latest output of the renderer to a texture"
+        if self.mode == 'cpu':
+            image = self.denoise_image()
+            self.cpu_output.update(numpy.ascontiguousarray(image[::-1,...]))
+            return self.cpu_output
+
+        r = self.renderer
+        self._render_pass(self.variance_shader, [self.variances[0]],
+            mean = r.latest,
+            moment = self.moments[0],
+            frame_number = float(r.n_samples))
+
+        source = r.latest
+        source_variance = self.variances[0]
+        aux_uniforms = { name: r.aux[name] for name in self.aux }
+        aux_uniforms.update({ 'sigma_' + name: self.sigmas['sigma_' + name] for name in self.aux })
+
+        for i in range(self.iterations):
+            target = self.filtered[i % 2]
+            target_variance = self.variances[(i + 1) % 2]
+            self._render_pass(self.filter_shader, [target, target_variance],
+                color = source,
+                variance = source_variance,
+                step_size = float(2**i),
+                sigma_color = self.sigmas['sigma_color'],
+                **aux_uniforms)
+            source, source_variance = target, target_variance
+
+        return source
+
+    def denoise_image(self):
+        "Denoise the latest output of the renderer to a float array"
+        r = self.renderer
+        if self.mode == 'gpu':
+            return r.framebuffer.read(self.denoise())
+
+        mean = r.read()
+        aux_images = { name: r.framebuffer.read(r.aux[name]) for name in self.aux }
+        return atrous_denoise(mean, mean, r.framebuffer.read(self.moments[0]),
+            r.n_samples, iterations=self.iterations, **aux_images, **self.sigmas)
@@ -63,6 +63,13 @@ def texture_rect(aspect, brightness=None):
     glVertex3f(-aspect, 1, 0)
     glEnd()
 
+def setup_projection(aspect):
+    glMatrixMode(GL_PROJECTION)
+    glOrtho(-aspect, aspect, -1, 1, 1, -1)
+
+    glMatrixMode(GL_MODELVIEW)
+    glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+
 PASSTHROUGH_VERTEX_SHADER = '''
     varying vec3 pos;
     void main() {
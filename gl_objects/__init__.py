@@ -1,3 +1,5 @@
 from .texture import Texture
+from .data_texture import DataTexture
 from .framebuffer import Framebuffer
 from .shader import Shader
+from .timer_query import TimerQuery
@@ -0,0 +1,153 @@
+"""
+Float data textures backed by memory-mapped .npy or raw binary files
+"""
+
+import hashlib
+import os
+import sys
+import numpy
+
+from OpenGL.GL import *
+from .texture import Texture
+
+# upper limit for the size of a single glTexSubImage2D upload
+CHUNK_BYTES = 16*1024*1024
+
+def load_data_array(filename, dtype=None, shape=None):
+    if filename.endswith('.npy'):
+        data = numpy.load(filename, mmap_mode='r')
+    else:
+        # raw binary, defaults to a flat float32 array
+        data = numpy.memmap(filename, dtype=dtype or 'float32', mode='r')
+    if shape is not None:
+        data = data.reshape(shape)
+    return data
+
+def file_hash(filename, block_size=1024*1024):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def flat_slice(data, start, stop):
+    """
+    data.reshape(-1)[start:stop] without copying the whole array when it
+    is not C-contiguous, e.g., a memory-mapped Fortran-ordered .npy file
+    """
+    if data.ndim <= 1 or data.flags.c_contiguous:
+        return data.reshape(-1)[start:stop]
+    if start >= stop:
+        return numpy.zeros(0, dtype=data.dtype)
+
+    row_size = data.size // data.shape[0]
+    parts = []
+    while start < stop:
+        row, offset = divmod(start, row_size)
+        if offset == 0 and stop - start >= row_size:
+            # whole rows, copies only these
+            n_rows = (stop - start) // row_size
+            parts.append(data[row:row+n_rows].reshape(-1))
+            start += n_rows*row_size
+        else:
+            end = min(stop, (row + 1)*row_size)
+            parts.append(flat_slice(data[row], offset, end - row*row_size))
+            start = end
+
+    return numpy.concatenate(parts)
+
+def packed_texture_size(n_texels, max_width):
+    w = max(min(n_texels, max_width), 1)
+    h = (n_texels + w - 1) // w
+    if h > max_width:
+        raise RuntimeError("%d texels do not fit in a %dx%d texture" % \
+            (n_texels, max_width, max_width))
+    return (w, h)
+
+class DataTexture(Texture):
+    """
+    RGBA32F texture loaded from a file. Arrays of shape (h, w, 4) are
+    uploaded as such, anything else is flattened and packed row by row into
+    a 2D texture of RGBA texels, texel i being at (i % w, i / w).
+    """
+    def __init__(self, filename, dtype=None, shape=None, max_width=None):
+        self.filename = os.path.abspath(filename)
+        self.dtype = dtype
+        self.shape = shape
+
+        if max_width is None:
+            max_width = glGetIntegerv(GL_MAX_TEXTURE_SIZE)
+        self.max_width = int(max_width)
+
+        self._file_stat = None
+        self._file_hash = None
+
+        Texture.__init__(self,
+            internal_format = GL_RGBA32F,
+            interpolation = GL_NEAREST,
+            format = GL_RGBA,
+            texture_wrap = GL_CLAMP_TO_EDGE,
+            type = GL_FLOAT)
+
+        self.reload()
+
+    @property
+    def size(self):
+        return [float(self.w), float(self.h)]
+
+    def reload(self):
+        """
+        Re-upload the file if its contents have changed. Returns True if
+        the texture was updated. If the file cannot be read (e.g., it is
+        being rewritten), the old texture is kept and the reload is retried
+        on the next call
+        """
+        try:
+            stat = os.stat(self.filename)
+            file_stat = (stat.st_mtime, stat.st_size)
+            if file_stat == self._file_stat:
+                return False
+
+            digest = file_hash(self.filename)
+            if digest != self._file_hash:
+                self._upload(load_data_array(self.filename, self.dtype, self.shape))
+        except (OSError, ValueError) as err:
+            # the initial load must succeed
+            if self._file_hash is None: raise
+            sys.stderr.write('failed to reload %s, keeping the old data: %s\n' % \
+                (self.filename, str(err)))
+            return False
+
+        self._file_stat = file_stat
+        updated = digest != self._file_hash
+        self._file_hash = digest
+        return updated
+
+    def _upload(self, data):
+        if data.ndim == 3 and data.shape[2] == 4:
+            h, w = data.shape[:2]
+            if w > self.max_width or h > self.max_width:
+                raise RuntimeError("data texture %s too large: %dx%d" % \
+                    (self.filename, w, h))
+
+            def get_rows(y0, y1):
+                return data[y0:y1]
+        else:
+            w, h = packed_texture_size((data.size + 3) // 4, self.max_width)
+
+            def get_rows(y0, y1):
+                rows = numpy.zeros((y1 - y0, w, 4), dtype=numpy.float32)
+                chunk = flat_slice(data, y0*w*4, min(y1*w*4, data.size))
+                rows.reshape(-1)[:chunk.size] = chunk
+                return rows
+
+        if (w, h) != (self.w, self.h):
+            self.w = w
+            self.h = h
+            self.allocate()
+
+        rows_per_chunk = max(CHUNK_BYTES // (w*4*4), 1)
+        for y0 in range(0, h, rows_per_chunk):
+            y1 = min(y0 + rows_per_chunk, h)
+            rows = numpy.ascontiguousarray(get_rows(y0, y1), dtype=numpy.float32)
+            self.update_rows(rows, y_offset=y0)
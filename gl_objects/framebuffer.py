@@ -21,15 +21,29 @@ class Framebuffer:
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
 
     @contextmanager
-    def render_to_texture(self, texture):
+    def render_to_texture(self, texture, *extra_textures):
+        # extra textures are written as gl_FragData[1], gl_FragData[2], ...
         with self._bind():
-            if isinstance(texture, Texture): texture = texture._gl_handle
-            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
+            attachments = [texture] + list(extra_textures)
+            for i, tex in enumerate(attachments):
+                if isinstance(tex, Texture): tex = tex._gl_handle
+                glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + i, GL_TEXTURE_2D, tex, 0)
+            if extra_textures:
+                draw_buffers = [GL_COLOR_ATTACHMENT0 + i for i in range(len(attachments))]
+                glDrawBuffers(len(draw_buffers), numpy.array(draw_buffers, dtype=numpy.uint32))
             yield
+            if extra_textures:
+                for i in range(1, len(attachments)):
+                    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + i, GL_TEXTURE_2D, 0, 0)
+                glDrawBuffers(1, numpy.array([GL_COLOR_ATTACHMENT0], dtype=numpy.uint32))
 
-    def read(self):
+    def read(self, texture=None, format=GL_RGB):
         with self._bind():
-            texture_data = glReadPixels(0, 0, self.w, self.h, GL_RGB, GL_FLOAT)
-            texture_data = numpy.reshape(texture_data, (self.h, self.w, 3))
+            if texture is not None:
+                if isinstance(texture, Texture): texture = texture._gl_handle
+                glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
+            channels = 4 if format == GL_RGBA else 3
+            texture_data = glReadPixels(0, 0, self.w, self.h, format, GL_FLOAT)
+            texture_data = numpy.reshape(texture_data, (self.h, self.w, channels))
             texture_data = texture_data[::-1,...]
             return texture_data
@@ -30,6 +30,11 @@ class Shader:
             name: glGetUniformLocation(self._gl_handle, str(name)) \
                 for name in self.uniforms.keys() }
 
+    def add_uniform(self, name, value):
+        from OpenGL.GL import glGetUniformLocation
+        self.uniforms[name] = value
+        self._uniform_handles[name] = glGetUniformLocation(self._gl_handle, str(name))
+
     # these implement the "with shader as ..." statement
     @contextmanager
     def use_program(self):
@@ -43,6 +43,17 @@ class Texture:
         with self.bind():
             glTexImage2D(GL_TEXTURE_2D, 0, self.internal_format, self.w, self.h, 0, self.format,self.type, content)
 
+    def allocate(self):
+        # reserve storage without uploading anything
+        with self.bind():
+            glTexImage2D(GL_TEXTURE_2D, 0, self.internal_format, self.w, self.h, 0, self.format, self.type, None)
+
+    def update_rows(self, content, y_offset=0):
+        assert(self.w == content.shape[1])
+        assert(y_offset + content.shape[0] <= self.h)
+        with self.bind():
+            glTexSubImage2D(GL_TEXTURE_2D, 0, 0, y_offset, self.w, content.shape[0], self.format, self.type, content)
+
     @contextmanager
     def bind(self):
         glBindTexture( GL_TEXTURE_2D, self._gl_handle )
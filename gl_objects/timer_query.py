@@ -0,0 +1,23 @@
+import ctypes
+import numpy
+from contextlib import contextmanager
+
+from OpenGL.GL import *
+
+class TimerQuery:
+    "Measures GPU time elapsed between GL commands"
+
+    def __init__(self):
+        self._gl_handle = int(numpy.ravel(glGenQueries(1))[0])
+
+    @contextmanager
+    def measure(self):
+        glBeginQuery(GL_TIME_ELAPSED, self._gl_handle)
+        yield
+        glEndQuery(GL_TIME_ELAPSED)
+
+    def read_nanoseconds(self):
+        # blocks until the result is available
+        result = ctypes.c_uint64()
+        glGetQueryObjectui64v(self._gl_handle, GL_QUERY_RESULT, ctypes.byref(result))
+        return result.value
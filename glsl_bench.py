@@ -14,6 +14,13 @@ def parse_command_line_arguments():
     arg_parser.add_argument('--max_samples', type=int, default=0)
     arg_parser.add_argument('-s', '--sleep', type=float, default=0.0)
     arg_parser.add_argument('--seed', default=None)
+    arg_parser.add_argument('--denoise', choices=['off', 'gpu', 'cpu'], default=None)
+    arg_parser.add_argument('--stats_every', type=int, default=0)
+    arg_parser.add_argument('--stats_output', default=None)
+    arg_parser.add_argument('--fireflies', choices=['report', 'reject', 'clamp'], default='report')
+    arg_parser.add_argument('--firefly_threshold', type=float, default=None)
+    arg_parser.add_argument('--firefly_ratio', type=float, default=10.0)
+    arg_parser.add_argument('--max_rejections', type=int, default=10)
 
     arg_parser.add_argument('shader_file')
     return arg_parser.parse_args()
@@ -50,7 +57,7 @@ def get_uniform_values_and_mappings(json_uniforms):
             uniforms[name] = value
     return (uniforms, bound_uniforms)
 
-def load_shader(json_path):
+def load_shader(json_path, source=None):
 
     if isinstance(json_path, str):
         import json
@@ -60,10 +67,12 @@ def load_shader(json_path):
         json_data = json_path
         shader_dir = DirChanger('.')
 
-    if 'source' in json_data:
-        source = json_data['source']
-    else:
-        source = shader_dir.read_file(json_data['source_path'])
+    # an explicitly given source overrides the one in the spec
+    if source is None:
+        if 'source' in json_data:
+            source = json_data['source']
+        else:
+            source = shader_dir.read_file(json_data['source_path'])
 
     uniforms, mappings = get_uniform_values_and_mappings(json_data['uniforms'])
     shader = Shader(json_data['resolution'], source, uniforms)
@@ -75,32 +84,14 @@ def load_shader(json_path):
 
     return shader
 
-def genrate_random_array(distribution, size):
-    if distribution == 'gauss': distribution = 'normal'
-    func = getattr(numpy.random, distribution)
-    return func(size=size)
-
-def generate_random(command):
-    parts = command.split('_')
-
-    assert(len(parts) <= 3)
-    assert(parts[0] == 'random')
-
-    distribution = parts[1]
-
-    if len(parts) > 1:
-        size = int(parts[2])
-    else:
-        size = 1
-
-    return list(genrate_random_array(distribution, size))
-
 def main(args):
 
     import time
-    from gl_boilerplate import texture_rect
-    from gl_objects import Texture, Framebuffer
+    from gl_boilerplate import texture_rect, setup_projection
     from output_shader import OutputShader
+    from renderer import Renderer
+    from denoise import Denoiser, parse_denoise_params
+    from image_stats import SampleMonitor
 
     t0 = time.time()
 
@@ -117,47 +108,58 @@ def main(args):
 
     shader.build()
 
-    monte_carlo = shader.params.get('monte_carlo')
-
     output_shader = OutputShader(
         resolution=shader.params['resolution'],
         gamma=shader.params.get('gamma', None),
         flip_y=shader.params.get('flip_y', False))
 
-    def new_texture():
-        extra_args = {}
-        # in Monte Carlo mode, use float32 textures
-        if shader.params.get('float_buffers') or monte_carlo:
-            extra_args['internal_format'] = GL_RGB32F
-        return Texture(*shader.resolution, \
-            interpolation=GL_NEAREST, content=0.0, **extra_args)
-
-    textures = [new_texture() for _ in range(2)]
-    framebuffer = Framebuffer(*shader.resolution)
-
     aspect = shader.aspect_ratio
-
-    glMatrixMode(GL_PROJECTION)
-    glOrtho(-aspect, aspect, -1, 1, 1, -1)
-
-    glMatrixMode(GL_MODELVIEW)
-    glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
-
-    n_samples = 0
+    setup_projection(aspect)
 
     refresh_every = shader.params.get('refresh_every', 1)
     if args.refresh_every is not None:
         refresh_every = args.refresh_every
 
+    glEnable( GL_TEXTURE_2D )
+
+    denoise_params = parse_denoise_params(shader.params.get('denoise'), args.denoise)
+    if denoise_params is not None:
+        renderer = Renderer(shader, aux_outputs=denoise_params.get('aux', []))
+        denoiser = Denoiser(renderer, **denoise_params)
+    else:
+        renderer = Renderer(shader)
+        denoiser = None
+
+    monitor = None
+    stats_output = None
+    if args.stats_every > 0 or args.fireflies != 'report':
+        if args.stats_output is not None:
+            stats_output = open(args.stats_output, 'w')
+        monitor = SampleMonitor(renderer,
+            every = args.stats_every,
+            fireflies = args.fireflies,
+            firefly_ratio = args.firefly_ratio,
+            firefly_threshold = args.firefly_threshold,
+            max_rejections = args.max_rejections,
+            output = stats_output)
+
+    def output_texture():
+        if denoiser is not None:
+            return denoiser.denoise()
+        return renderer.latest
+
     def save_results():
         if args.numpy_output_file is not None:
             # read image data from the framebuffer
-            result_image = framebuffer.read()
+            if denoiser is not None:
+                result_image = denoiser.denoise_image()
+            else:
+                result_image = renderer.read()
             # save raw 32-bit float / HDR channels as a numpy array
             numpy.save(args.numpy_output_file, result_image)
 
         if args.png_output_file is not None:
-            with output_shader.use_program(textures[1]._gl_handle):
+            with output_shader.use_program(output_texture()._gl_handle):
                 texture_rect(aspect)
 
             w, h = shader.params['resolution']
@@ -169,43 +171,6 @@ def main(args):
             import PIL.Image
             PIL.Image.fromarray(result_image).save(args.png_output_file)
 
-    glEnable( GL_TEXTURE_2D )
-
-    # handle compile time uniforms
-    for name in list(shader.uniform_mappings.keys())[::]:
-        source = shader.uniform_mappings[name]
-        if isinstance(source, dict):
-            def data_texture(**kwargs):
-                return Texture(
-                    internal_format = GL_RGBA32F,
-                    interpolation=GL_NEAREST,
-                    format = GL_RGBA,
-                    texture_wrap=GL_CLAMP_TO_EDGE,
-                    type = GL_FLOAT,
-                    **kwargs)
-
-            if 'random' in source:
-                n = source['random']['size']
-                shader.uniforms[name] = data_texture(
-                    w = n*4,
-                    h = 1,
-                    content = numpy.zeros((1,n*4,4)))
-                continue # updated on each frame
-            elif 'data' in source:
-                data = numpy.array(source['data'])
-                shader.uniforms[name] = data_texture(content = data)
-            else:
-                # dict is texture file name
-                with shader.dir.as_working_dir():
-                    shader.uniforms[name] = Texture.load(source['file'])
-        elif source == 'resolution':
-            shader.uniforms[name] = [float(c) for c in shader.resolution]
-        else:
-            # the rest are run-time mapped values
-            continue
-
-        del shader.uniform_mappings[name]
-
     def get_rel_mouse():
         x,y = pygame.mouse.get_pos()
         return [x / float(window_resolution[0]), y / float(window_resolution[1])]
@@ -216,57 +181,38 @@ def main(args):
 
     def do_quit():
         save_results()
+        if stats_output is not None:
+            stats_output.close()
         pygame.quit()
         quit()
 
     while True:
-        n_samples += 1
-
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 do_quit()
 
-        with shader.use_program():
-            with framebuffer.render_to_texture(textures[1]):
-
-                for name, source in shader.uniform_mappings.items():
-                    if isinstance(source, dict):
-                        r = source['random']
-                        tex = shader.uniforms[name]
-                        tex.update(genrate_random_array(r['distribution'], (tex.h, tex.w, 4)))
-                        continue # no need to use with set_uniforms
-                    elif source == 'time':
-                        value = time.time() - t0
-                    elif source == 'previous_frame':
-                        value = textures[0]
-                    elif source == 'mouse':
-                        value = get_absolute_mouse()
-                    elif source == 'relative_mouse':
-                        value = get_rel_mouse()
-                    elif source == 'frame_number':
-                        value = float(n_samples)
-                    elif 'random_' in source:
-                        value = generate_random(source)
-                    else:
-                        raise RuntimeError('invalid uniform mapping %s <- %s' % (name, source))
-
-                    shader.uniforms[name] = value
-
-                shader.set_uniforms()
-
-                # render
-                texture_rect(aspect)
+        renderer.render(
+            time = time.time() - t0,
+            mouse = get_absolute_mouse(),
+            relative_mouse = get_rel_mouse())
+
+        # rejected samples are not accumulated, the next one takes their place
+        accepted = monitor is None or monitor.check_latest()
+
+        if accepted and denoiser is not None:
+            denoiser.accumulate()
+
+        n_samples = renderer.n_samples
 
         if n_samples % refresh_every == 0:
-            # render from texture 1
-            with output_shader.use_program(textures[1]._gl_handle):
+            renderer.reload_data_textures()
+
+            # render the latest frame
+            with output_shader.use_program(output_texture()._gl_handle):
                 texture_rect(aspect)
 
             pygame.display.flip()
 
-        # flip buffers
-        textures = textures[::-1]
-
         if args.max_samples > 0 and n_samples >= args.max_samples:
             do_quit()
 
@@ -0,0 +1,363 @@
+"""
+GPU image statistics by repeated block reduction, so that only a few bytes
+need to be read back: per-channel mean and max of the finite pixels, NaN and
+Inf counts and a coarse luminance histogram.
+
+Samples of Monte Carlo renders are reconstructed from two consecutive means
+like in denoise.py, which allows detecting and rejecting or clamping NaNs
+and fireflies before they are accumulated.
+"""
+
+import json
+import sys
+
+import numpy
+
+from gl_objects import Shader, Texture, Framebuffer
+
+# luminance histogram of 8 bins with edges at 2^k, k = -3, ..., 3. The
+# first and last bins are open
+HISTOGRAM_MIN_EXPONENT = -3
+
+# default for the firefly criterion, see FIREFLY_GLSL
+FIREFLY_RATIO = 10.0
+
+BLOCK_SIZE = 8
+
+NON_FINITE_GLSL = """
+    bool is_nan(float x) { return !(x < 0.0 || x > 0.0 || x == 0.0); }
+    bool is_non_finite(vec3 c) {
+        return is_nan(c.r) || is_nan(c.g) || is_nan(c.b) ||
+            any(greaterThan(abs(c), vec3(3.0e38)));
+    }
+"""
+
+# a sample is a firefly in a pixel if its largest component exceeds
+# firefly_ratio times that of the running mean plus firefly_threshold.
+# Pixels that are bright in every sample, e.g., light sources, never are
+FIREFLY_GLSL = """
+    uniform float firefly_ratio;
+    uniform float firefly_threshold;
+    bool is_firefly(vec3 x, vec3 m_old, float frame_number) {
+        float limit = firefly_ratio * max(m_old.r, max(m_old.g, m_old.b)) + firefly_threshold;
+        return frame_number > 1.0 && max(x.r, max(x.g, x.b)) > limit;
+    }
+"""
+
+def buildFirstReductionFragmentShader(block_size):
+    return NON_FINITE_GLSL + FIREFLY_GLSL + """
+    uniform sampler2D source;
+    uniform sampler2D previous;
+    uniform float frame_number;
+    uniform vec2 source_size;
+
+    const vec3 LUMINANCE = vec3(0.2126, 0.7152, 0.0722);
+
+    void main() {
+        vec2 base = floor(gl_FragCoord.xy) * float(%(block_size)d);
+        vec4 sum = vec4(0.0);
+        vec4 mx = vec4(vec3(-3.0e38), 0.0);
+        vec4 hist0 = vec4(0.0), hist1 = vec4(0.0);
+        float fireflies = 0.0;
+
+        for (int dy = 0; dy < %(block_size)d; dy++) {
+            for (int dx = 0; dx < %(block_size)d; dx++) {
+                vec2 p = base + vec2(float(dx), float(dy));
+                if (p.x >= source_size.x || p.y >= source_size.y) continue;
+                vec2 uv = (p + 0.5) / source_size;
+
+                // with frame_number = 0, this is just the source image
+                vec3 m_old = texture2D(previous, uv).rgb;
+                vec3 c = (frame_number + 1.0) * texture2D(source, uv).rgb
+                    - frame_number * m_old;
+
+                if (is_nan(c.r) || is_nan(c.g) || is_nan(c.b)) {
+                    mx.w += 1.0;
+                } else if (!is_non_finite(c)) {
+                    sum += vec4(c, 1.0);
+                    mx.rgb = max(mx.rgb, c);
+                    float lum = dot(c, LUMINANCE);
+                    float bin = 0.0;
+                    if (lum > 0.0) bin = clamp(floor(log2(lum)) + %(bin_offset).1f, 0.0, 7.0);
+                    hist0 += vec4(equal(vec4(bin), vec4(0.0, 1.0, 2.0, 3.0)));
+                    hist1 += vec4(equal(vec4(bin), vec4(4.0, 5.0, 6.0, 7.0)));
+                    if (is_firefly(c, m_old, frame_number)) fireflies += 1.0;
+                }
+            }
+        }
+
+        gl_FragData[0] = sum;
+        gl_FragData[1] = mx;
+        gl_FragData[2] = hist0;
+        gl_FragData[3] = hist1;
+        gl_FragData[4] = vec4(fireflies, 0.0, 0.0, 0.0);
+    }""" % { 'block_size': block_size, 'bin_offset': 1 - HISTOGRAM_MIN_EXPONENT }
+
+def buildCombineReductionFragmentShader(block_size):
+    return """
+    uniform sampler2D sums;
+    uniform sampler2D maxima;
+    uniform sampler2D histogram0;
+    uniform sampler2D histogram1;
+    uniform sampler2D fireflies;
+    uniform vec2 source_size;
+
+    void main() {
+        vec2 base = floor(gl_FragCoord.xy) * float(%(block_size)d);
+        vec4 sum = vec4(0.0);
+        vec4 mx = vec4(vec3(-3.0e38), 0.0);
+        vec4 hist0 = vec4(0.0), hist1 = vec4(0.0), n_fireflies = vec4(0.0);
+
+        for (int dy = 0; dy < %(block_size)d; dy++) {
+            for (int dx = 0; dx < %(block_size)d; dx++) {
+                vec2 p = base + vec2(float(dx), float(dy));
+                if (p.x >= source_size.x || p.y >= source_size.y) continue;
+                vec2 uv = (p + 0.5) / source_size;
+
+                n_fireflies += texture2D(fireflies, uv);
+                sum += texture2D(sums, uv);
+                vec4 m = texture2D(maxima, uv);
+                mx = vec4(max(mx.rgb, m.rgb), mx.w + m.w);
+                hist0 += texture2D(histogram0, uv);
+                hist1 += texture2D(histogram1, uv);
+            }
+        }
+
+        gl_FragData[0] = sum;
+        gl_FragData[1] = mx;
+        gl_FragData[2] = hist0;
+        gl_FragData[3] = hist1;
+        gl_FragData[4] = n_fireflies;
+    }""" % { 'block_size': block_size }
+
+def buildClampSampleFragmentShader(resolution):
+    from output_shader import formatResolution
+    return NON_FINITE_GLSL + FIREFLY_GLSL + """
+    uniform sampler2D mean;
+    uniform sampler2D previous_mean;
+    uniform float frame_number;
+
+    void main() {
+        %s;
+        vec2 uv = gl_FragCoord.xy / resolution.xy;
+        vec3 m_old = texture2D(previous_mean, uv).xyz;
+        vec3 x = (frame_number + 1.0) * texture2D(mean, uv).xyz - frame_number * m_old;
+
+        if (is_non_finite(x)) {
+            // drop the sample
+            x = m_old;
+        } else if (is_firefly(x, m_old, frame_number)) {
+            float limit = firefly_ratio * max(m_old.r, max(m_old.g, m_old.b)) + firefly_threshold;
+            x *= limit / max(x.r, max(x.g, x.b));
+        }
+        gl_FragColor = vec4((m_old * frame_number + x) / (frame_number + 1.0), 1.0);
+    }""" % formatResolution(resolution)
+
+class _ReductionLevel:
+    def __init__(self, w, h):
+        from OpenGL.GL import GL_RGBA, GL_RGBA32F, GL_NEAREST, GL_CLAMP_TO_EDGE
+        self.w = w
+        self.h = h
+        self.framebuffer = Framebuffer(w, h)
+        self.textures = [Texture(w, h,
+                content = numpy.zeros((h, w, 4), dtype=numpy.float32),
+                format = GL_RGBA,
+                internal_format = GL_RGBA32F,
+                interpolation = GL_NEAREST,
+                texture_wrap = GL_CLAMP_TO_EDGE) \
+            for _ in range(5)]
+
+class ImageStats:
+    def __init__(self, resolution, block_size=BLOCK_SIZE):
+        self.resolution = resolution
+        self.block_size = block_size
+
+        self.levels = []
+        w, h = resolution
+        while len(self.levels) == 0 or (w, h) != (1, 1):
+            w = (w + block_size - 1) // block_size
+            h = (h + block_size - 1) // block_size
+            self.levels.append(_ReductionLevel(w, h))
+
+        def build(source, uniform_names):
+            shader = Shader(resolution, source,
+                uniforms = { name: None for name in uniform_names })
+            shader.build()
+            return shader
+
+        self.first_shader = build(buildFirstReductionFragmentShader(block_size),
+            ['source', 'previous', 'frame_number', 'source_size',
+             'firefly_ratio', 'firefly_threshold'])
+        self.combine_shader = build(buildCombineReductionFragmentShader(block_size),
+            ['sums', 'maxima', 'histogram0', 'histogram1', 'fireflies', 'source_size'])
+
+    def _reduce(self, shader, level, **uniforms):
+        from gl_boilerplate import texture_rect
+        with shader.use_program():
+            with level.framebuffer.render_to_texture(*level.textures):
+                shader.set_uniforms(**uniforms)
+                texture_rect(shader.aspect_ratio)
+
+    def compute(self, texture, previous=None, frame_number=0,
+            firefly_ratio=FIREFLY_RATIO, firefly_threshold=None):
+        """
+        Statistics of a texture of the given resolution, or of the sample
+        reconstructed from it and the previous Monte Carlo mean if
+        frame_number > 0. Fireflies are only counted in the latter case
+        and if firefly_threshold is given
+        """
+        from OpenGL.GL import GL_RGBA
+
+        if previous is None: previous = texture
+        if firefly_threshold is None: firefly_threshold = 3.0e38
+
+        source_size = [float(c) for c in self.resolution]
+        self._reduce(self.first_shader, self.levels[0],
+            source = texture,
+            previous = previous,
+            frame_number = float(frame_number),
+            source_size = source_size,
+            firefly_ratio = float(firefly_ratio),
+            firefly_threshold = float(firefly_threshold))
+
+        for prev_level, level in zip(self.levels[:-1], self.levels[1:]):
+            sums, maxima, histogram0, histogram1, fireflies = prev_level.textures
+            self._reduce(self.combine_shader, level,
+                sums = sums,
+                maxima = maxima,
+                histogram0 = histogram0,
+                histogram1 = histogram1,
+                fireflies = fireflies,
+                source_size = [float(prev_level.w), float(prev_level.h)])
+
+        top = self.levels[-1]
+        sums, maxima, histogram0, histogram1, fireflies = [ \
+            top.framebuffer.read(tex, format=GL_RGBA)[0, 0, :].astype(numpy.float64) \
+                for tex in top.textures]
+
+        n_pixels = self.resolution[0] * self.resolution[1]
+        n_finite = int(round(sums[3]))
+        n_nan = int(round(maxima[3]))
+
+        if n_finite > 0:
+            mean = [float(c) for c in sums[:3] / n_finite]
+            maximum = [float(c) for c in maxima[:3]]
+        else:
+            mean = maximum = None
+
+        return {
+            'mean': mean,
+            'max': maximum,
+            'nan': n_nan,
+            'inf': n_pixels - n_finite - n_nan,
+            'fireflies': int(round(fireflies[0])),
+            'histogram': [int(round(c)) for c in numpy.concatenate([histogram0, histogram1])]
+        }
+
+class SampleMonitor:
+    def __init__(self, renderer, every=0, fireflies='report', firefly_ratio=FIREFLY_RATIO,
+            firefly_threshold=None, max_rejections=10, output=None):
+        """
+        Monitor the output of a Renderer. Statistics of the accumulated
+        image are written as JSON lines every N rendered samples. With
+        fireflies 'reject' or 'clamp', each Monte Carlo sample is checked
+        before it is accumulated: pixels with NaN/Inf are dropped and, if
+        firefly_threshold is given, firefly pixels (see FIREFLY_GLSL) are
+        clamped. In 'reject' mode the whole sample is re-rendered instead,
+        but after max_rejections consecutive rejections the monitor warns
+        and switches to clamping for good, as the problem is persistent.
+        """
+        if fireflies not in ('report', 'reject', 'clamp'):
+            raise RuntimeError('invalid firefly mode %s' % fireflies)
+        if fireflies != 'report' and not renderer.monte_carlo:
+            raise RuntimeError('firefly %s requires a monte_carlo spec' % fireflies)
+
+        self.renderer = renderer
+        self.every = every
+        self.fireflies = fireflies
+        self.firefly_params = {
+            'firefly_ratio': firefly_ratio,
+            'firefly_threshold': firefly_threshold
+        }
+        self.max_rejections = max_rejections
+        self.output = output or sys.stdout
+        self.n_rendered = 0
+        self.n_rejected = 0
+        self.n_clamped = 0
+        self._consecutive_rejections = 0
+
+        self.stats = ImageStats(renderer.shader.resolution)
+
+        if fireflies != 'report':
+            resolution = renderer.shader.resolution
+            self.clamp_shader = Shader(resolution, buildClampSampleFragmentShader(resolution),
+                uniforms = { name: None for name in \
+                    ['mean', 'previous_mean', 'frame_number',
+                     'firefly_ratio', 'firefly_threshold'] })
+            self.clamp_shader.build()
+            self.scratch = renderer.new_float_texture()
+
+    def _clamp_latest(self):
+        from gl_boilerplate import texture_rect
+        r = self.renderer
+        threshold = self.firefly_params['firefly_threshold']
+        if threshold is None: threshold = 3.0e38
+
+        with self.clamp_shader.use_program():
+            with r.framebuffer.render_to_texture(self.scratch):
+                self.clamp_shader.set_uniforms(
+                    mean = r.latest,
+                    previous_mean = r.textures[1],
+                    frame_number = float(r.n_samples),
+                    firefly_ratio = float(self.firefly_params['firefly_ratio']),
+                    firefly_threshold = float(threshold))
+                texture_rect(self.clamp_shader.aspect_ratio)
+
+        r.textures[0], self.scratch = self.scratch, r.textures[0]
+
+    def check_latest(self):
+        """
+        Call after each Renderer.render. Returns False if the sample was
+        rejected
+        """
+        r = self.renderer
+        self.n_rendered += 1
+        accepted = True
+
+        if self.fireflies != 'report':
+            stats = self.stats.compute(r.latest, r.textures[1], r.n_samples,
+                **self.firefly_params)
+            if stats['nan'] > 0 or stats['inf'] > 0 or stats['fireflies'] > 0:
+                if self.fireflies == 'reject' and \
+                        self._consecutive_rejections >= self.max_rejections:
+                    sys.stderr.write('%d consecutive samples rejected, clamping from now on\n' % \
+                        self._consecutive_rejections)
+                    self.fireflies = 'clamp'
+
+                if self.fireflies == 'reject':
+                    r.reject_latest()
+                    self.n_rejected += 1
+                    self._consecutive_rejections += 1
+                    accepted = False
+                else:
+                    self._clamp_latest()
+                    self.n_clamped += 1
+
+            if accepted:
+                self._consecutive_rejections = 0
+
+        if self.every > 0 and self.n_rendered % self.every == 0:
+            self.report()
+
+        return accepted
+
+    def report(self):
+        stats = self.stats.compute(self.renderer.latest)
+        del stats['fireflies'] # not meaningful for the accumulated image
+        stats['sample'] = self.renderer.n_samples
+        stats['rendered'] = self.n_rendered
+        if self.n_rejected > 0 or self.n_clamped > 0 or self.fireflies != 'report':
+            stats['rejected'] = self.n_rejected
+            stats['clamped'] = self.n_clamped
+        self.output.write(json.dumps(stats) + '\n')
+        self.output.flush()
@@ -0,0 +1,167 @@
+"""
+Renders samples of a shader spec to ping-pong float textures
+"""
+
+import numpy
+
+from OpenGL.GL import *
+
+from gl_boilerplate import texture_rect
+from gl_objects import Texture, DataTexture, Framebuffer
+
+def genrate_random_array(distribution, size):
+    if distribution == 'gauss': distribution = 'normal'
+    func = getattr(numpy.random, distribution)
+    return func(size=size)
+
+def generate_random(command):
+    parts = command.split('_')
+
+    assert(len(parts) <= 3)
+    assert(parts[0] == 'random')
+
+    distribution = parts[1]
+
+    if len(parts) > 1:
+        size = int(parts[2])
+    else:
+        size = 1
+
+    return list(genrate_random_array(distribution, size))
+
+class Renderer:
+    def __init__(self, shader, aux_outputs=()):
+        """
+        Bind the compile time uniforms of a built shader (see load_shader)
+        and allocate the render targets. Each name in aux_outputs gets an
+        extra float texture, written by the shader to gl_FragData[1], ...
+        in the given order
+        """
+        self.shader = shader
+        self.monte_carlo = shader.params.get('monte_carlo')
+        self.n_samples = 0
+
+        self.textures = [self._new_texture() for _ in range(2)]
+        self.framebuffer = Framebuffer(*shader.resolution)
+        self.aux = { name: self.new_float_texture() for name in aux_outputs }
+
+        # file-backed data textures, by the name of their size uniform
+        self.data_textures = {}
+
+        self._bind_compile_time_uniforms()
+
+    @property
+    def latest(self):
+        "the texture rendered to on the last call of render"
+        return self.textures[0]
+
+    def new_float_texture(self):
+        return Texture(*self.shader.resolution, \
+            interpolation=GL_NEAREST, content=0.0, internal_format=GL_RGB32F)
+
+    def _new_texture(self):
+        extra_args = {}
+        # in Monte Carlo mode, use float32 textures
+        if self.shader.params.get('float_buffers') or self.monte_carlo:
+            extra_args['internal_format'] = GL_RGB32F
+        return Texture(*self.shader.resolution, \
+            interpolation=GL_NEAREST, content=0.0, **extra_args)
+
+    def _bind_compile_time_uniforms(self):
+        shader = self.shader
+
+        for name in list(shader.uniform_mappings.keys())[::]:
+            source = shader.uniform_mappings[name]
+            if isinstance(source, dict):
+                def data_texture(**kwargs):
+                    return Texture(
+                        internal_format = GL_RGBA32F,
+                        interpolation=GL_NEAREST,
+                        format = GL_RGBA,
+                        texture_wrap=GL_CLAMP_TO_EDGE,
+                        type = GL_FLOAT,
+                        **kwargs)
+
+                if 'random' in source:
+                    n = source['random']['size']
+                    shader.uniforms[name] = data_texture(
+                        w = n*4,
+                        h = 1,
+                        content = numpy.zeros((1,n*4,4)))
+                    continue # updated on each frame
+                elif 'data' in source:
+                    data = numpy.array(source['data'], dtype=numpy.float32)
+                    shader.uniforms[name] = data_texture(content = data)
+                elif 'data_file' in source:
+                    with shader.dir.as_working_dir():
+                        tex = DataTexture(source['data_file'],
+                            dtype = source.get('dtype'),
+                            shape = source.get('shape'))
+                    shader.uniforms[name] = tex
+                    size_name = source.get('size_uniform', name + '_size')
+                    shader.add_uniform(size_name, tex.size)
+                    self.data_textures[size_name] = tex
+                else:
+                    # dict is texture file name
+                    with shader.dir.as_working_dir():
+                        shader.uniforms[name] = Texture.load(source['file'])
+            elif source == 'resolution':
+                shader.uniforms[name] = [float(c) for c in shader.resolution]
+            else:
+                # the rest are run-time mapped values
+                continue
+
+            del shader.uniform_mappings[name]
+
+    def reload_data_textures(self):
+        for size_name, tex in self.data_textures.items():
+            if tex.reload():
+                self.shader.uniforms[size_name] = tex.size
+
+    def render(self, time, mouse=(0.0, 0.0), relative_mouse=(0.0, 0.0)):
+        "Render one sample to a new texture, which then becomes latest"
+        shader = self.shader
+        self.n_samples += 1
+
+        with shader.use_program():
+            with self.framebuffer.render_to_texture(self.textures[1], *self.aux.values()):
+
+                for name, source in shader.uniform_mappings.items():
+                    if isinstance(source, dict):
+                        r = source['random']
+                        tex = shader.uniforms[name]
+                        tex.update(genrate_random_array(r['distribution'], (tex.h, tex.w, 4)))
+                        continue # no need to use with set_uniforms
+                    elif source == 'time':
+                        value = time
+                    elif source == 'previous_frame':
+                        value = self.textures[0]
+                    elif source == 'mouse':
+                        value = list(mouse)
+                    elif source == 'relative_mouse':
+                        value = list(relative_mouse)
+                    elif source == 'frame_number':
+                        value = float(self.n_samples)
+                    elif 'random_' in source:
+                        value = generate_random(source)
+                    else:
+                        raise RuntimeError('invalid uniform mapping %s <- %s' % (name, source))
+
+                    shader.uniforms[name] = value
+
+                shader.set_uniforms()
+
+                # render
+                texture_rect(shader.aspect_ratio)
+
+        # flip buffers
+        self.textures = self.textures[::-1]
+
+    def reject_latest(self):
+        "Discard the last sample, the next one is rendered in its place"
+        self.textures = self.textures[::-1]
+        self.n_samples -= 1
+
+    def read(self):
+        "Read the latest output as a float array"
+        return self.framebuffer.read(self.latest)
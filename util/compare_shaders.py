@@ -0,0 +1,154 @@
+"""
+A/B comparison of two shader variants: GPU timings and output differences.
+
+    python util/compare_shaders.py --spec examples/pathtracer/conf.json a.glsl b.glsl
+    python util/compare_shaders.py a.json b.json
+
+Both variants are rendered alternately in the same GL context with the same
+random numbers. Exits with status 1 unless B is faster than A (with the given
+confidence) and their float outputs are within the given tolerances.
+"""
+
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def speedup_interval(times_a, times_b, z=1.96):
+    """
+    Speedup mean(A) / mean(B) and its confidence interval, using the
+    normal approximation of the log-ratio of the means
+    """
+    times_a = numpy.asarray(times_a, dtype=numpy.float64)
+    times_b = numpy.asarray(times_b, dtype=numpy.float64)
+    mean_a, mean_b = times_a.mean(), times_b.mean()
+
+    def rel_var(t, m):
+        return t.var(ddof=1) / (len(t) * m**2)
+
+    speedup = mean_a / mean_b
+    half_width = z * numpy.sqrt(rel_var(times_a, mean_a) + rel_var(times_b, mean_b))
+    return (speedup, speedup * numpy.exp(-half_width), speedup * numpy.exp(half_width))
+
+def image_difference(reference, image):
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    diff = numpy.asarray(image, dtype=numpy.float64) - reference
+    finite = numpy.isfinite(diff)
+
+    rmse = numpy.sqrt(numpy.mean(diff[finite]**2)) if finite.any() else 0.0
+    max_abs = numpy.max(numpy.abs(diff[finite])) if finite.any() else 0.0
+
+    finite_ref = reference[numpy.isfinite(reference)]
+    peak = numpy.max(numpy.abs(finite_ref)) if finite_ref.size > 0 else 0.0
+    if peak == 0: peak = 1.0
+    if rmse > 0:
+        psnr = 20 * numpy.log10(peak / rmse)
+    else:
+        psnr = float('inf')
+
+    return {
+        'rmse': float(rmse),
+        'psnr': float(psnr),
+        'max_abs_error': float(max_abs),
+        'non_finite': int(numpy.sum(~finite))
+    }
+
+def compare(shaders, n_samples, warmup, seed, time_step):
+    from OpenGL.GL import glEnable, GL_TEXTURE_2D
+    from gl_boilerplate import setup_projection
+    from gl_objects import TimerQuery
+    from renderer import Renderer
+
+    for shader in shaders: shader.build()
+
+    setup_projection(shaders[0].aspect_ratio)
+    glEnable( GL_TEXTURE_2D )
+
+    renderers = [Renderer(shader) for shader in shaders]
+    timer = TimerQuery()
+    timings = [[] for _ in renderers]
+
+    for i in range(warmup + n_samples):
+        # alternate the order (ABBA...) to cancel out drift
+        order = [0, 1] if i % 2 == 0 else [1, 0]
+        for j in order:
+            numpy.random.seed(seed + i)
+            with timer.measure():
+                renderers[j].render(time = (i + 1) * time_step)
+            elapsed = timer.read_nanoseconds()
+            if i >= warmup:
+                timings[j].append(elapsed * 1e-6)
+
+    images = [r.read() for r in renderers]
+    return (timings, images)
+
+if __name__ == '__main__':
+    def parse_args():
+        import argparse
+        parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+
+        parser.add_argument('a', help='baseline spec, or shader if --spec is given')
+        parser.add_argument('b', help='candidate spec, or shader if --spec is given')
+        parser.add_argument('--spec', default=None)
+        parser.add_argument('-n', '--samples', type=int, default=100)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--time_step', type=float, default=1/60.0)
+        parser.add_argument('--confidence_z', type=float, default=1.96)
+        parser.add_argument('--min_psnr', type=float, default=40.0)
+        parser.add_argument('--max_abs_error', type=float, default=None)
+        args = parser.parse_args()
+        if args.samples < 2:
+            parser.error('at least 2 samples are needed for confidence intervals')
+        return args
+
+    args = parse_args()
+
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    import pygame
+    import pygame.locals
+
+    from glsl_bench import load_shader, read_file
+
+    if args.spec is not None:
+        shaders = [load_shader(args.spec, source=read_file(fn)) for fn in (args.a, args.b)]
+    else:
+        shaders = [load_shader(fn) for fn in (args.a, args.b)]
+
+    if shaders[0].resolution != shaders[1].resolution:
+        raise RuntimeError('resolutions differ: %s vs %s' % \
+            (shaders[0].resolution, shaders[1].resolution))
+
+    pygame.init()
+    # only needed for the GL context, rendering is off-screen
+    pygame.display.set_mode((64, 64), pygame.locals.DOUBLEBUF | pygame.locals.OPENGL)
+
+    timings, images = compare(shaders,
+        n_samples = args.samples,
+        warmup = args.warmup,
+        seed = args.seed,
+        time_step = args.time_step)
+
+    pygame.quit()
+
+    for label, t in zip(('A', 'B'), timings):
+        print('%s: %.3f ms/sample (std %.3f, min %.3f, n=%d)' % \
+            (label, numpy.mean(t), numpy.std(t, ddof=1), numpy.min(t), len(t)))
+
+    speedup, low, high = speedup_interval(*timings, z=args.confidence_z)
+    print('speedup B/A: %.3fx [%.3f, %.3f]' % (speedup, low, high))
+
+    diff = image_difference(*images)
+    print('RMSE %g, PSNR %.2f dB, max abs error %g, non-finite %d' % \
+        (diff['rmse'], diff['psnr'], diff['max_abs_error'], diff['non_finite']))
+
+    faster = low > 1.0
+    equivalent = diff['psnr'] >= args.min_psnr and diff['non_finite'] == 0
+    if args.max_abs_error is not None:
+        equivalent = equivalent and diff['max_abs_error'] <= args.max_abs_error
+
+    print('faster: %s, equivalent: %s' % (faster, equivalent))
+    sys.exit(0 if faster and equivalent else 1)